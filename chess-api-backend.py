@@ -1,17 +1,78 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
 from flask_cors import CORS
 from flask_swagger_ui import get_swaggerui_blueprint
 import chess
 import chess.engine
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import os
-from typing import List, Dict, Optional
-from dataclasses import dataclass, asdict
+import sys
+import queue
+import threading
+from array import array
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache
+from operator import attrgetter
+from typing import List, Dict, Iterator, Optional
+from dataclasses import dataclass, replace
 import json
+import hashlib
+import time
+import logging
+from logging.handlers import QueueHandler, QueueListener
+import atexit
+
+from flask.json.provider import DefaultJSONProvider
+
+from move_classify import classify_legal_moves
+
+try:
+    import orjson  # Optional: much faster serialization of large analyses
+except ImportError:
+    orjson = None
+
+class OrjsonProvider(DefaultJSONProvider):
+    """jsonify() backed by orjson; parsing stays with the stdlib"""
+
+    def dumps(self, obj, **kwargs) -> str:
+        return orjson.dumps(obj, default=self.default).decode()
+
+    def response(self, *args, **kwargs) -> Response:
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj, default=self.default),
+                                        mimetype=self.mimetype)
 
 app = Flask(__name__)
 CORS(app)
 
+if orjson is not None:
+    app.json = OrjsonProvider(app)
+# Key order is irrelevant to clients; sorting every response is wasted work
+app.json.sort_keys = False
+
+logger = logging.getLogger(__name__)
+
+# Log level from the environment (e.g. LOG_LEVEL=DEBUG while developing)
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'WARNING').upper()
+
+def setup_logging():
+    """Sends log records through a queue so request threads never block on stderr"""
+    log_queue = queue.Queue(-1)
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+    listener = QueueListener(log_queue, handler)
+    listener.start()
+    # The listener thread is a daemon: flush what is still queued on exit
+    atexit.register(listener.stop)
+    logger.addHandler(QueueHandler(log_queue))
+    logger.setLevel(LOG_LEVEL)
+    logger.propagate = False
+
+setup_logging()
+
 # Swagger UI configuration
 SWAGGER_URL = '/api/docs'
 API_URL = '/api/swagger.json'
@@ -30,11 +91,337 @@ app.register_blueprint(swaggerui_blueprint, url_prefix=SWAGGER_URL)
 STOCKFISH_PATH = "stockfish"  # Adjust according to operating system
 # STOCKFISH_PATH = "C:\\Path\\To\\stockfish.exe"  # Windows
 
-# Game storage
-games = {}
+# Engine pool configuration
+# By default one engine per core, leaving one core for the web server, up
+# to DEFAULT_POOL_MAX: every engine is started at boot and holds its own
+# STOCKFISH_HASH_MB table, so the memory cost grows with the pool.
+# STOCKFISH_POOL_SIZE overrides it (e.g. on shared or large hosts)
+DEFAULT_POOL_MAX = 4
+ENGINE_POOL_SIZE = max(1, int(os.environ.get('STOCKFISH_POOL_SIZE') or 0)
+                       or min(DEFAULT_POOL_MAX, (os.cpu_count() or 1) - 1))
+# Search threads per engine: the engine cores shared out between the pool,
+# so a smaller pool gets multi-threaded engines instead of idle cores
+ENGINE_THREADS = max(1, int(os.environ.get('STOCKFISH_THREADS') or 0)
+                     or max(1, (os.cpu_count() or 1) - 1) // ENGINE_POOL_SIZE)
+ENGINE_HASH_MB = int(os.environ.get('STOCKFISH_HASH_MB') or 256)
+# Core pinning assumes this process owns the machine's cores; with several
+# server processes (gunicorn workers) each would pin to the same cores
+ENGINE_PIN_CORES = os.environ.get('STOCKFISH_PIN_CORES', '1') != '0'
+
+def valid_seconds(value) -> bool:
+    """True for a finite, non-negative number of seconds (JSON booleans excluded)"""
+    return (isinstance(value, (int, float)) and not isinstance(value, bool)
+            and 0 <= value < float('inf'))
+
+def env_seconds(name: str, default: str) -> float:
+    """Reads a number of seconds from the environment, exiting if it is invalid"""
+    raw = os.environ.get(name, default)
+    try:
+        value = float(raw)
+    except ValueError:
+        value = None
+    if not valid_seconds(value):
+        sys.exit(f"{name} must be a non-negative number of seconds, got {raw!r}")
+    return value
+
+# Wall-clock cap (seconds) per Stockfish search, on top of the depth limit:
+# tactical positions can take far longer to reach a given depth than quiet
+# ones, so this bounds the slowest responses at the cost of depth there.
+# 0 disables the cap. Clients can override it with "max_time".
+SF_MAX_TIME = env_seconds('SF_MAX_TIME', '0.5')
+
+class EnginePool:
+    """Pool of long-lived Stockfish processes shared by all requests"""
+
+    def __init__(self, path: str, size: int):
+        self.path = path
+        self.size = size
+        # Each slot holds a running engine, or None until it is first needed
+        self._slots = queue.Queue()
+        for _ in range(size):
+            self._slots.put(None)
+        self._skill_levels = {}  # Last Skill Level applied to each engine
+        self.engine_name = None  # Reported by the engine (e.g. "Stockfish 16.1")
+        # Core assignments (see _pin_to_core) not held by a live engine;
+        # a discarded engine gives its own back for its replacement
+        self._free_core_sets = list(range(size))
+        self._core_sets = {}  # Core assignment of each live engine
+        self._lock = threading.Lock()
 
-@dataclass
+    def _spawn(self) -> chess.engine.SimpleEngine:
+        """Starts and configures a new Stockfish process"""
+        engine = chess.engine.SimpleEngine.popen_uci(self.path)
+        engine.configure({"Hash": ENGINE_HASH_MB, "Threads": ENGINE_THREADS})
+        self.engine_name = engine.id.get('name')
+        # Engines can be spawned by concurrent requests: claim a distinct set
+        with self._lock:
+            core_set = self._core_sets[engine] = self._free_core_sets.pop(0)
+        self._pin_to_core(engine, core_set)
+        return engine
+
+    def _pin_to_core(self, engine: chess.engine.SimpleEngine, core_set: int):
+        """Pins an engine process to its own cores (Linux only).
+
+        The first available core is left to the web server; core set n
+        is ENGINE_THREADS consecutive cores, round-robin over the
+        remaining ones, so the engines' caches don't thrash each other.
+        """
+        if not ENGINE_PIN_CORES or not hasattr(os, 'sched_setaffinity'):
+            return
+        cores = sorted(os.sched_getaffinity(0))
+        if len(cores) < 2:
+            return
+        engine_cores = cores[1:]
+        start = core_set * ENGINE_THREADS
+        own = {engine_cores[(start + i) % len(engine_cores)] for i in range(ENGINE_THREADS)}
+        try:
+            os.sched_setaffinity(engine.protocol.transport.get_pid(), own)
+        except OSError as e:
+            logger.warning("Could not pin Stockfish to cores %s: %s", sorted(own), e)
+
+    def _discard(self, engine: chess.engine.SimpleEngine):
+        """Shuts down an engine that can no longer be trusted"""
+        self._skill_levels.pop(engine, None)
+        with self._lock:
+            core_set = self._core_sets.pop(engine, None)
+            if core_set is not None:
+                self._free_core_sets.append(core_set)
+        try:
+            engine.close()
+        except Exception:
+            pass
+
+    @contextmanager
+    def acquire(self, skill_level: int = 20):
+        """Borrows an engine configured with the given Skill Level"""
+        engine = self._slots.get()
+        try:
+            if engine is None:
+                engine = self._spawn()
+            # Only send setoption when the strength actually changes
+            if self._skill_levels.get(engine) != skill_level:
+                engine.configure({"Skill Level": skill_level})
+                self._skill_levels[engine] = skill_level
+            yield engine
+        except chess.engine.EngineError:
+            # Crashed or desynchronized engine: respawn it on next use
+            if engine is not None:
+                self._discard(engine)
+            engine = None
+            raise
+        finally:
+            self._slots.put(engine)
+
+    def warm_up(self):
+        """Starts every engine and runs a tiny search before traffic arrives.
+
+        The first search pays for NNUE network loading and hash allocation;
+        doing it at startup keeps that cost away from the first request.
+        """
+        engines = [self._slots.get() for _ in range(self.size)]
+        try:
+            for i, engine in enumerate(engines):
+                if engine is None:
+                    engine = engines[i] = self._spawn()
+                engine.ping()  # isready / readyok
+                engine.analyse(chess.Board(), chess.engine.Limit(depth=1))
+        finally:
+            for engine in engines:
+                self._slots.put(engine)
+
+    def close(self):
+        """Quits every idle engine"""
+        while True:
+            try:
+                engine = self._slots.get_nowait()
+            except queue.Empty:
+                break
+            if engine is not None:
+                self._discard(engine)
+
+engine_pool = EnginePool(STOCKFISH_PATH, ENGINE_POOL_SIZE)
+
+# Analysis cache configuration
+ANALYSIS_CACHE_SIZE = 4096
+
+class LRUCache:
+    """Thread-safe least-recently-used cache"""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, count_miss: bool = True):
+        """Returns the cached value for key, or None.
+
+        Opportunistic lookups that fall back to another key pass
+        count_miss=False, so one request doesn't record two misses.
+        """
+        with self._lock:
+            value = self._data.get(key)
+            if value is not None:
+                self._data.move_to_end(key)
+                self.hits += 1
+            elif count_miss:
+                self.misses += 1
+            return value
+
+    def put(self, key, value):
+        """Stores value, evicting the least recently used entry if full"""
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        """Drops every entry and resets the statistics"""
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def info(self) -> Dict:
+        """Hit/miss statistics, in the spirit of functools' cache_info()"""
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'maxsize': self.maxsize,
+                'currsize': len(self._data)
+            }
+
+# Finished analyses keyed by (engine, position, search parameters)
+analysis_cache = LRUCache(ANALYSIS_CACHE_SIZE)
+
+# Analyses currently being computed, so concurrent duplicates wait instead
+_inflight = {}  # cache key -> Future
+_inflight_lock = threading.Lock()
+
+def cached_analysis(cache_key: tuple, fen: str, compute,
+                    max_age: Optional[float] = None) -> Optional['EngineAnalysis']:
+    """Returns the analysis for cache_key, running compute() at most once.
+
+    Concurrent requests for the same key wait for the first one's result
+    (single-flight) instead of starting a duplicate engine search. With
+    max_age, entries are stored with the time they were computed and
+    recomputed once they are max_age seconds old.
+    """
+    analysis = analysis_cache.get(cache_key)
+    if analysis is not None and max_age is not None:
+        computed_at, analysis = analysis
+        if time.monotonic() - computed_at >= max_age:
+            analysis = None
+    if analysis is None:
+        with _inflight_lock:
+            future = _inflight.get(cache_key)
+            is_leader = future is None
+            if is_leader:
+                future = _inflight[cache_key] = Future()
+        
+        if is_leader:
+            try:
+                analysis = compute()
+                if analysis is not None:
+                    analysis_cache.put(cache_key, analysis if max_age is None
+                                       else (time.monotonic(), analysis))
+                future.set_result(analysis)
+            except BaseException as e:
+                future.set_exception(e)
+                raise
+            finally:
+                with _inflight_lock:
+                    del _inflight[cache_key]
+        else:
+            analysis = future.result()
+    
+    if analysis is None:
+        return None
+    # Cached entries may come from a transposition with different move clocks
+    return replace(analysis, fen=fen)
+
+def position_key(board: chess.Board) -> tuple:
+    """Hashable position identity that ignores the halfmove/fullmove clocks.
+
+    Uses python-chess's transposition key (piece bitboards, side to move,
+    castling rights, en passant square), which is far cheaper than
+    formatting a FEN string or computing chess.polyglot.zobrist_hash.
+    It is the one position identity for caches and ETags alike.
+    """
+    # Private python-chess API: present in the pinned chess==1.11.2
+    # (requirements.txt); recheck it when upgrading python-chess
+    return board._transposition_key()
+
+# Shared HTTP session: keeps TLS connections to lichess.org alive between calls
+http_session = requests.Session()
+http_session.headers['User-Agent'] = 'Advanced-Chess-API/1.0'
+http_session.mount('https://', HTTPAdapter(
+    pool_connections=20,
+    pool_maxsize=50,
+    max_retries=Retry(total=2, backoff_factor=0.2, status_forcelist=(502, 503, 504))
+))
+
+# Game storage configuration
+MAX_GAMES = 10000
+GAME_TTL_SECONDS = 3600  # Games idle for longer are dropped
+
+class GameStore:
+    """Thread-safe game storage bounded in size and expiring idle games"""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._games = OrderedDict()  # game_id -> (last access time, game data)
+        self.lock = threading.RLock()
+
+    def get(self, game_id: str) -> Optional[Dict]:
+        """Returns the game data (refreshing its expiry), or None"""
+        with self.lock:
+            entry = self._games.get(game_id)
+            if entry is None:
+                return None
+            now = time.monotonic()
+            if now - entry[0] > self.ttl:
+                del self._games[game_id]
+                return None
+            self._games[game_id] = (now, entry[1])
+            self._games.move_to_end(game_id)
+            return entry[1]
+
+    def put(self, game_id: str, game_data: Dict):
+        """Stores a game, dropping expired and least recently used games"""
+        with self.lock:
+            now = time.monotonic()
+            self._games[game_id] = (now, game_data)
+            self._games.move_to_end(game_id)
+            # Oldest entries come first, so stop at the first one still alive
+            while self._games:
+                oldest_id, (last_access, _) = next(iter(self._games.items()))
+                if len(self._games) <= self.maxsize and now - last_access <= self.ttl:
+                    break
+                del self._games[oldest_id]
+
+    def __contains__(self, game_id: str) -> bool:
+        return self.get(game_id) is not None
+
+games = GameStore(MAX_GAMES, GAME_TTL_SECONDS)
+
+# Worker threads for engine calls that can overlap within one request
+BACKGROUND_WORKERS = 8
+background_executor = ThreadPoolExecutor(max_workers=BACKGROUND_WORKERS,
+                                         thread_name_prefix='chess-api')
+
+# Frozen: cached analyses are shared between requests and must not change
+@dataclass(frozen=True)
 class MoveEvaluation:
+    # Analyses hold one instance per legal move: slots keep them small.
+    # Declared by hand because dataclass(slots=True) needs Python 3.10
+    __slots__ = ('move', 'evaluation', 'is_mate', 'mate_in', 'is_capture',
+                 'piece', 'from_square', 'to_square')
+    
     move: str
     evaluation: float  # In centipawns or mate
     is_mate: bool
@@ -44,910 +431,776 @@ class MoveEvaluation:
     from_square: str
     to_square: str
 
-@dataclass
+    def to_dict(self) -> Dict:
+        """Flat dict for JSON responses (avoids asdict's recursive deep copy)"""
+        return {
+            'move': self.move,
+            'evaluation': self.evaluation,
+            'is_mate': self.is_mate,
+            'mate_in': self.mate_in,
+            'is_capture': self.is_capture,
+            'piece': self.piece,
+            'from_square': self.from_square,
+            'to_square': self.to_square
+        }
+
+@dataclass(frozen=True)
 class EngineAnalysis:
-    best_move: str
+    __slots__ = ('best_move', 'top_moves', 'all_legal_moves', 'capture_moves',
+                 'position_evaluation', 'fen')
+    
+    best_move: Optional[str]  # None when the side to move has no legal move
     top_moves: List[MoveEvaluation]
     all_legal_moves: List[MoveEvaluation]
     capture_moves: List[MoveEvaluation]
     position_evaluation: float
     fen: str
 
+    def to_dict(self, max_moves: Optional[int] = None) -> Dict:
+        """Dict for JSON responses, built without asdict's deep copy.
+
+        max_moves truncates the move lists without re-sorting them. Only
+        Stockfish's full analysis (include_all_moves) stores them best
+        first; other engines keep move-generation order, so the cut there
+        is not by strength.
+        """
+        return {
+            'best_move': self.best_move,
+            'top_moves': [m.to_dict() for m in self.top_moves],
+            'all_legal_moves': [m.to_dict() for m in self.all_legal_moves[:max_moves]],
+            'capture_moves': [m.to_dict() for m in self.capture_moves[:max_moves]],
+            'position_evaluation': self.position_evaluation,
+            'fen': self.fen
+        }
+
+# C-level sort key for MoveEvaluation lists
+BY_EVALUATION = attrgetter('evaluation')
+
+# Template for the most common case: games starting from the initial position
+STARTPOS_BOARD = chess.Board()
+
+@lru_cache(maxsize=4096)
+def _board_from_fen(fen: str) -> chess.Board:
+    """Parses a FEN once; callers must copy the returned template board"""
+    return chess.Board(fen)
+
+# Move strings and square names recur across requests and games; both
+# parsers are pure, and Move objects are never mutated, so they can be shared
+@lru_cache(maxsize=8192)
+def parse_move(uci: str) -> chess.Move:
+    """Memoized chess.Move.from_uci()"""
+    return chess.Move.from_uci(uci)
+
+@lru_cache(maxsize=128)
+def parse_square(name: str) -> chess.Square:
+    """Memoized chess.parse_square()"""
+    return chess.parse_square(name)
+
+def board_template(fen: Optional[str] = None) -> chess.Board:
+    """Shared, read-only board for a FEN (the starting position if omitted)"""
+    if not fen or fen == chess.STARTING_FEN:
+        return STARTPOS_BOARD
+    return _board_from_fen(fen)
+
+def new_board(fen: Optional[str] = None) -> chess.Board:
+    """Returns a fresh board for a FEN (the starting position if omitted)"""
+    return board_template(fen).copy(stack=False)
+
+def same_position(board: chess.Board, template: chess.Board) -> bool:
+    """True if both boards have the same position and move counters"""
+    return (board.halfmove_clock == template.halfmove_clock
+            and board.fullmove_number == template.fullmove_number
+            and position_key(board) == position_key(template))
+
 def get_or_create_game(game_id: str, fen: Optional[str] = None, 
                        player_color: str = 'white', 
                        engine_strength: int = 20) -> Dict:
     """Gets an existing game or creates a new one from a FEN"""
-    if game_id not in games:
-        board = chess.Board() if not fen else chess.Board(fen)
-        games[game_id] = {
-            'board': board,
-            'player_color': player_color,
-            'moves': [],
-            'engine_strength': engine_strength,
-            'current_engine': 'stockfish'  # Default engine
-        }
-        print(f"📝 New game created: {game_id} (FEN: {board.fen()[:50]}...)")
-    elif fen:
-        # If FEN is provided, update the position
-        games[game_id]['board'] = chess.Board(fen)
-        print(f"🔄 Game {game_id} updated with new FEN")
+    with games.lock:
+        game_data = games.get(game_id)
+        if game_data is None:
+            board = new_board(fen)
+            game_data = {
+                'board': board,
+                'player_color': player_color,
+                'moves': array('H'),  # encode_move() codes, see moves_history()
+                'engine_strength': engine_strength,
+                'current_engine': 'stockfish',  # Default engine
+                'lock': threading.RLock()  # Serializes moves, syncs and analyses
+            }
+            games.put(game_id, game_data)
+            logger.debug("📝 New game created: %s", game_id)
+            return game_data
     
-    return games[game_id]
+    if fen:
+        # If FEN is provided, update the position. Clients resend the FEN
+        # they already have with most requests; keeping the board then also
+        # keeps its move stack (needed for repetition detection)
+        template = board_template(fen)
+        with game_data['lock']:
+            if same_position(game_data['board'], template):
+                return game_data
+            game_data['board'] = template.copy(stack=False)
+            game_data['fen'] = None
+        logger.debug("🔄 Game %s updated with new FEN", game_id)
+    
+    return game_data
+
+def game_fen(game_data: Dict) -> str:
+    """FEN of a game's board, formatted once per position.
+
+    Callers must hold the game lock. Every change to the board goes
+    through push_move() or a FEN sync, which reset the cached string.
+    """
+    fen = game_data.get('fen')
+    if fen is None:
+        fen = game_data['fen'] = game_data['board'].fen()
+    return fen
+
+def push_move(game_data: Dict, move: chess.Move):
+    """Plays a move on a game's board; callers must hold the game lock"""
+    game_data['board'].push(move)
+    game_data['moves'].append(encode_move(move))
+    game_data['fen'] = None
+
+def encode_move(move: chess.Move) -> int:
+    """Packs a move into 16 bits: from square, to square, promotion piece type"""
+    return move.from_square << 10 | move.to_square << 4 | (move.promotion or 0)
+
+@lru_cache(maxsize=None)  # At most 2**16 codes
+def decoded_uci(code: int) -> str:
+    """UCI string of an encode_move() code"""
+    return chess.Move(code >> 10, (code >> 4) & 0x3f, (code & 0xf) or None).uci()
+
+def moves_history(game_data: Dict) -> List[str]:
+    """The game's moves as UCI strings; callers must hold the game lock"""
+    return [decoded_uci(code) for code in game_data['moves']]
+
+def snapshot_game(game_id: str) -> Optional[Dict]:
+    """Copies the board and settings of a game under its lock"""
+    game_data = games.get(game_id)
+    if game_data is None:
+        return None
+    with game_data['lock']:
+        return {
+            'board': game_data['board'].copy(),
+            'fen': game_fen(game_data),
+            'engine_strength': game_data.get('engine_strength', 20)
+        }
+
+# OpenAPI document served at /api/swagger.json, kept as a plain JSON file
+SWAGGER_SPEC_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'swagger.json')
+
+def load_swagger_spec() -> Dict:
+    """Loads the Swagger/OpenAPI specification"""
+    with open(SWAGGER_SPEC_PATH, encoding='utf-8') as f:
+        return json.load(f)
+
+# The specification is static: serialize it once at import time
+SWAGGER_SPEC_BYTES = json.dumps(load_swagger_spec(), separators=(',', ':')).encode()
+SWAGGER_SPEC_ETAG = hashlib.md5(SWAGGER_SPEC_BYTES).hexdigest()
+
+def error_body(message: str) -> bytes:
+    """Serialized {"error": message} body"""
+    return json.dumps({'error': message}, separators=(',', ':')).encode()
+
+# Fixed error bodies, serialized once. Responses themselves can't be shared
+# between requests (after_request hooks such as CORS add headers to them)
+ERR_GAME_NOT_FOUND = error_body('Game not found')
+ERR_GAME_NOT_FOUND_NO_FEN = error_body('Game not found and no FEN provided')
+ERR_FEN_REQUIRED = error_body('FEN required')
+ERR_INVALID_ENGINE = error_body('Invalid engine')
+ERR_ANALYSIS = error_body('Analysis error')
+ERR_STRENGTH_RANGE = error_body('Strength must be an integer between 1 and 20')
+ERR_JSON_BODY = error_body('Request body must be a JSON object')
+ERR_MAX_MOVES = error_body('max_moves must be a non-negative integer')
+ERR_MAX_TIME = error_body('max_time must be a non-negative number of seconds')
+ERR_GAME_IDS_REQUIRED = error_body('game_ids must be a non-empty list of strings')
+ERR_BATCH_TOO_LARGE = error_body('Too many game_ids in one batch')
+ERR_TOP_MOVES = error_body('top_moves must be an integer between 1 and 50')
+ERR_DEPTH = error_body('depth must be an integer between 1 and 100')
+ERR_BATCH_TOP_MOVES = error_body('top_moves must be an integer between 1 and 5')
+
+def error_response(body: bytes, status: int) -> Response:
+    """JSON error response around a pre-serialized body"""
+    return Response(body, status=status, mimetype='application/json')
+
+def valid_int(value, low: int, high: int) -> bool:
+    """True for an integer from low to high (JSON booleans excluded)"""
+    return isinstance(value, int) and not isinstance(value, bool) and low <= value <= high
+
+def valid_strength(value) -> bool:
+    """True for an integer engine strength from 1 to 20"""
+    return valid_int(value, 1, 20)
+
+def json_body() -> Optional[Dict]:
+    """The request's JSON object, or None if the body is missing or malformed"""
+    data = request.get_json(silent=True)
+    return data if isinstance(data, dict) else None
 
 @app.route('/api/swagger.json')
 def swagger_spec():
     """Returns the Swagger/OpenAPI specification"""
-    spec = {
-        "openapi": "3.0.0",
-        "info": {
-            "title": "Advanced Chess API",
-            "description": "Multi-engine chess API with Stockfish, Lichess, and Chess.com support. Features FEN synchronization, position analysis, and configurable engine strength.",
-            "version": "1.0.0",
-            "contact": {
-                "name": "Chess API Support"
-            }
-        },
-        "servers": [
-            {
-                "url": "http://localhost:5000",
-                "description": "Local development server"
-            }
-        ],
-        "tags": [
-            {
-                "name": "Game Management",
-                "description": "Endpoints for creating and managing chess games"
-            },
-            {
-                "name": "Moves",
-                "description": "Endpoints for making and analyzing moves"
-            },
-            {
-                "name": "Analysis",
-                "description": "Position analysis and evaluation endpoints"
-            },
-            {
-                "name": "Configuration",
-                "description": "Engine configuration endpoints"
-            }
-        ],
-        "paths": {
-            "/new_game": {
-                "post": {
-                    "tags": ["Game Management"],
-                    "summary": "Start a new chess game",
-                    "description": "Creates a new game with optional FEN position, player color, and engine settings",
-                    "requestBody": {
-                        "required": True,
-                        "content": {
-                            "application/json": {
-                                "schema": {
-                                    "type": "object",
-                                    "properties": {
-                                        "game_id": {
-                                            "type": "string",
-                                            "default": "default",
-                                            "description": "Unique identifier for the game"
-                                        },
-                                        "color": {
-                                            "type": "string",
-                                            "enum": ["white", "black"],
-                                            "default": "white",
-                                            "description": "Player's color"
-                                        },
-                                        "engine_strength": {
-                                            "type": "integer",
-                                            "minimum": 1,
-                                            "maximum": 20,
-                                            "default": 20,
-                                            "description": "Engine strength level (1=weakest, 20=strongest)"
-                                        },
-                                        "engine": {
-                                            "type": "string",
-                                            "enum": ["stockfish", "lichess", "chesscom"],
-                                            "default": "stockfish",
-                                            "description": "Chess engine to use"
-                                        },
-                                        "fen": {
-                                            "type": "string",
-                                            "description": "Optional FEN string for custom starting position"
-                                        }
-                                    }
-                                },
-                                "examples": {
-                                    "default_game": {
-                                        "summary": "Default new game",
-                                        "value": {
-                                            "game_id": "game1",
-                                            "color": "white",
-                                            "engine_strength": 20,
-                                            "engine": "stockfish"
-                                        }
-                                    },
-                                    "custom_position": {
-                                        "summary": "Game from FEN",
-                                        "value": {
-                                            "game_id": "custom1",
-                                            "color": "white",
-                                            "engine": "lichess",
-                                            "fen": "rnbqkbnr/pppppppp/8/8/4P3/8/PPPP1PPP/RNBQKBNR b KQkq e3 0 1"
-                                        }
-                                    }
-                                }
-                            }
-                        }
-                    },
-                    "responses": {
-                        "200": {
-                            "description": "Game created successfully",
-                            "content": {
-                                "application/json": {
-                                    "schema": {
-                                        "type": "object",
-                                        "properties": {
-                                            "game_id": {"type": "string"},
-                                            "fen": {"type": "string"},
-                                            "player_color": {"type": "string"},
-                                            "engine_strength": {"type": "integer"},
-                                            "engine": {"type": "string"},
-                                            "ai_move": {"type": "string"},
-                                            "analysis": {"type": "object"}
-                                        }
-                                    }
-                                }
-                            }
-                        }
-                    }
-                }
-            },
-            "/make_move": {
-                "post": {
-                    "tags": ["Moves"],
-                    "summary": "Make a player move",
-                    "description": "Processes the player's move and returns the engine's response",
-                    "requestBody": {
-                        "required": True,
-                        "content": {
-                            "application/json": {
-                                "schema": {
-                                    "type": "object",
-                                    "required": ["move"],
-                                    "properties": {
-                                        "game_id": {
-                                            "type": "string",
-                                            "default": "default"
-                                        },
-                                        "move": {
-                                            "type": "string",
-                                            "description": "Move in UCI format (e.g., 'e2e4')"
-                                        },
-                                        "fen": {
-                                            "type": "string",
-                                            "description": "Optional FEN for position sync"
-                                        },
-                                        "engine": {
-                                            "type": "string",
-                                            "enum": ["stockfish", "lichess", "chesscom"],
-                                            "default": "stockfish"
-                                        },
-                                        "engine_strength": {
-                                            "type": "integer",
-                                            "minimum": 1,
-                                            "maximum": 20,
-                                            "default": 20
-                                        }
-                                    }
-                                },
-                                "examples": {
-                                    "simple_move": {
-                                        "summary": "Simple move",
-                                        "value": {
-                                            "game_id": "game1",
-                                            "move": "e2e4",
-                                            "engine": "stockfish"
-                                        }
-                                    }
-                                }
-                            }
-                        }
-                    },
-                    "responses": {
-                        "200": {
-                            "description": "Move processed successfully",
-                            "content": {
-                                "application/json": {
-                                    "schema": {
-                                        "type": "object",
-                                        "properties": {
-                                            "success": {"type": "boolean"},
-                                            "player_move": {"type": "string"},
-                                            "ai_move": {"type": "string"},
-                                            "fen": {"type": "string"},
-                                            "game_over": {"type": "boolean"},
-                                            "moves_history": {
-                                                "type": "array",
-                                                "items": {"type": "string"}
-                                            },
-                                            "analysis": {"type": "object"}
-                                        }
-                                    }
-                                }
-                            }
-                        },
-                        "400": {
-                            "description": "Illegal move or error"
-                        }
-                    }
-                }
-            },
-            "/sync_position": {
-                "post": {
-                    "tags": ["Game Management"],
-                    "summary": "Synchronize board position",
-                    "description": "Synchronizes the board position with the backend using FEN",
-                    "requestBody": {
-                        "required": True,
-                        "content": {
-                            "application/json": {
-                                "schema": {
-                                    "type": "object",
-                                    "required": ["fen"],
-                                    "properties": {
-                                        "game_id": {
-                                            "type": "string",
-                                            "default": "default"
-                                        },
-                                        "fen": {
-                                            "type": "string",
-                                            "description": "FEN string of current position"
-                                        },
-                                        "player_color": {
-                                            "type": "string",
-                                            "enum": ["white", "black"],
-                                            "default": "white"
-                                        },
-                                        "engine_strength": {
-                                            "type": "integer",
-                                            "minimum": 1,
-                                            "maximum": 20,
-                                            "default": 20
-                                        }
-                                    }
-                                }
-                            }
-                        }
-                    },
-                    "responses": {
-                        "200": {
-                            "description": "Position synchronized"
-                        },
-                        "400": {
-                            "description": "FEN required"
-                        }
-                    }
-                }
-            },
-            "/analyze_position": {
-                "post": {
-                    "tags": ["Analysis"],
-                    "summary": "Analyze current position",
-                    "description": "Analyzes the current position with the chosen engine",
-                    "requestBody": {
-                        "required": True,
-                        "content": {
-                            "application/json": {
-                                "schema": {
-                                    "type": "object",
-                                    "properties": {
-                                        "game_id": {
-                                            "type": "string",
-                                            "default": "default"
-                                        },
-                                        "engine": {
-                                            "type": "string",
-                                            "enum": ["stockfish", "lichess", "chesscom"],
-                                            "default": "stockfish"
-                                        },
-                                        "top_moves": {
-                                            "type": "integer",
-                                            "default": 5,
-                                            "description": "Number of top moves to return"
-                                        },
-                                        "depth": {
-                                            "type": "integer",
-                                            "default": 20,
-                                            "description": "Search depth for Stockfish"
-                                        },
-                                        "fen": {
-                                            "type": "string",
-                                            "description": "Optional FEN for position sync"
-                                        }
-                                    }
-                                },
-                                "examples": {
-                                    "stockfish_analysis": {
-                                        "summary": "Stockfish deep analysis",
-                                        "value": {
-                                            "game_id": "game1",
-                                            "engine": "stockfish",
-                                            "top_moves": 5,
-                                            "depth": 20
-                                        }
-                                    },
-                                    "lichess_analysis": {
-                                        "summary": "Lichess cloud analysis",
-                                        "value": {
-                                            "game_id": "game1",
-                                            "engine": "lichess",
-                                            "top_moves": 3
-                                        }
-                                    }
-                                }
-                            }
-                        }
-                    },
-                    "responses": {
-                        "200": {
-                            "description": "Analysis completed",
-                            "content": {
-                                "application/json": {
-                                    "schema": {
-                                        "type": "object",
-                                        "properties": {
-                                            "best_move": {"type": "string"},
-                                            "top_moves": {"type": "array"},
-                                            "all_legal_moves": {"type": "array"},
-                                            "capture_moves": {"type": "array"},
-                                            "position_evaluation": {"type": "number"},
-                                            "fen": {"type": "string"}
-                                        }
-                                    }
-                                }
-                            }
-                        },
-                        "404": {
-                            "description": "Game not found"
-                        },
-                        "500": {
-                            "description": "Analysis error"
-                        }
-                    }
-                }
-            },
-            "/set_engine_strength": {
-                "post": {
-                    "tags": ["Configuration"],
-                    "summary": "Set engine strength",
-                    "description": "Changes the engine strength level (1-20)",
-                    "requestBody": {
-                        "required": True,
-                        "content": {
-                            "application/json": {
-                                "schema": {
-                                    "type": "object",
-                                    "required": ["strength"],
-                                    "properties": {
-                                        "game_id": {
-                                            "type": "string",
-                                            "default": "default"
-                                        },
-                                        "strength": {
-                                            "type": "integer",
-                                            "minimum": 1,
-                                            "maximum": 20,
-                                            "description": "Engine strength (1=weakest, 20=strongest)"
-                                        },
-                                        "fen": {
-                                            "type": "string",
-                                            "description": "Optional FEN for position sync"
-                                        }
-                                    }
-                                },
-                                "examples": {
-                                    "beginner": {
-                                        "summary": "Beginner level",
-                                        "value": {
-                                            "game_id": "game1",
-                                            "strength": 5
-                                        }
-                                    },
-                                    "expert": {
-                                        "summary": "Expert level",
-                                        "value": {
-                                            "game_id": "game1",
-                                            "strength": 20
-                                        }
-                                    }
-                                }
-                            }
-                        }
-                    },
-                    "responses": {
-                        "200": {
-                            "description": "Strength updated"
-                        },
-                        "400": {
-                            "description": "Invalid strength value"
-                        },
-                        "404": {
-                            "description": "Game not found"
-                        }
-                    }
-                }
-            },
-            "/get_capture_moves": {
-                "get": {
-                    "tags": ["Analysis"],
-                    "summary": "Get capture moves",
-                    "description": "Returns only capture moves with evaluation",
-                    "parameters": [
-                        {
-                            "name": "game_id",
-                            "in": "query",
-                            "schema": {
-                                "type": "string",
-                                "default": "default"
-                            }
-                        },
-                        {
-                            "name": "engine",
-                            "in": "query",
-                            "schema": {
-                                "type": "string",
-                                "enum": ["stockfish", "lichess", "chesscom"],
-                                "default": "stockfish"
-                            }
-                        },
-                        {
-                            "name": "fen",
-                            "in": "query",
-                            "schema": {
-                                "type": "string"
-                            },
-                            "description": "Optional FEN for position sync"
-                        }
-                    ],
-                    "responses": {
-                        "200": {
-                            "description": "Capture moves returned",
-                            "content": {
-                                "application/json": {
-                                    "schema": {
-                                        "type": "object",
-                                        "properties": {
-                                            "capture_moves": {"type": "array"},
-                                            "total_captures": {"type": "integer"}
-                                        }
-                                    }
-                                }
-                            }
-                        },
-                        "404": {
-                            "description": "Game not found"
-                        },
-                        "500": {
-                            "description": "Analysis error"
-                        }
-                    }
-                }
-            },
-            "/legal_moves": {
-                "get": {
-                    "tags": ["Moves"],
-                    "summary": "Get legal moves",
-                    "description": "Returns legal moves for a specific square",
-                    "parameters": [
-                        {
-                            "name": "game_id",
-                            "in": "query",
-                            "schema": {
-                                "type": "string",
-                                "default": "default"
-                            }
-                        },
-                        {
-                            "name": "square",
-                            "in": "query",
-                            "schema": {
-                                "type": "string"
-                            },
-                            "description": "Square in algebraic notation (e.g., 'e2')"
-                        },
-                        {
-                            "name": "fen",
-                            "in": "query",
-                            "schema": {
-                                "type": "string"
-                            },
-                            "description": "Optional FEN for position sync"
-                        }
-                    ],
-                    "responses": {
-                        "200": {
-                            "description": "Legal moves returned",
-                            "content": {
-                                "application/json": {
-                                    "schema": {
-                                        "type": "object",
-                                        "properties": {
-                                            "legal_moves": {
-                                                "type": "array",
-                                                "items": {
-                                                    "type": "object",
-                                                    "properties": {
-                                                        "to": {"type": "string"},
-                                                        "move": {"type": "string"},
-                                                        "is_capture": {"type": "boolean"}
-                                                    }
-                                                }
-                                            }
-                                        }
-                                    }
-                                }
-                            }
-                        },
-                        "404": {
-                            "description": "Game not found"
-                        }
-                    }
-                }
-            },
-            "/compare_engines": {
-                "post": {
-                    "tags": ["Analysis"],
-                    "summary": "Compare engines",
-                    "description": "Compares the best move from different engines",
-                    "requestBody": {
-                        "required": True,
-                        "content": {
-                            "application/json": {
-                                "schema": {
-                                    "type": "object",
-                                    "properties": {
-                                        "game_id": {
-                                            "type": "string",
-                                            "default": "default"
-                                        },
-                                        "fen": {
-                                            "type": "string",
-                                            "description": "Optional FEN for position sync"
-                                        }
-                                    }
-                                }
-                            }
-                        }
-                    },
-                    "responses": {
-                        "200": {
-                            "description": "Engine comparison completed",
-                            "content": {
-                                "application/json": {
-                                    "schema": {
-                                        "type": "object",
-                                        "properties": {
-                                            "stockfish": {
-                                                "type": "object",
-                                                "properties": {
-                                                    "best_move": {"type": "string"},
-                                                    "evaluation": {"type": "number"},
-                                                    "top_3": {"type": "array"}
-                                                }
-                                            },
-                                            "lichess": {
-                                                "type": "object",
-                                                "properties": {
-                                                    "best_move": {"type": "string"},
-                                                    "evaluation": {"type": "number"},
-                                                    "top_3": {"type": "array"}
-                                                }
-                                            }
-                                        }
-                                    }
-                                }
-                            }
-                        },
-                        "404": {
-                            "description": "Game not found"
-                        }
-                    }
-                }
-            }
-        }
-    }
-    return jsonify(spec)
+    response = Response(SWAGGER_SPEC_BYTES, mimetype='application/json')
+    response.set_etag(SWAGGER_SPEC_ETAG)
+    response.headers['Cache-Control'] = 'public, max-age=3600'
+    # Answers 304 Not Modified when the client's If-None-Match matches
+    return response.make_conditional(request)
 
 @app.route('/new_game', methods=['POST'])
 def new_game():
     """Starts a new game"""
-    data = request.json
+    data = json_body()
+    if data is None:
+        return error_response(ERR_JSON_BODY, 400)
     game_id = data.get('game_id', 'default')
     player_color = data.get('color', 'white')
     engine_strength = data.get('engine_strength', 20)  # 1-20, 20 = maximum
     engine_type = data.get('engine', 'stockfish')  # stockfish, lichess, chesscom
     fen = data.get('fen')  # Optional FEN
     
-    game_data = get_or_create_game(game_id, fen, player_color, engine_strength)
-    game_data['current_engine'] = engine_type
+    if not valid_strength(engine_strength):
+        return error_response(ERR_STRENGTH_RANGE, 400)
     
-    response = {
-        'game_id': game_id,
-        'fen': game_data['board'].fen(),
-        'player_color': player_color,
-        'engine_strength': engine_strength,
-        'engine': engine_type
-    }
+    game_data = get_or_create_game(game_id, fen, player_color, engine_strength)
     
-    # If the player chose black, the engine makes the first move
-    if player_color == 'black':
-        analysis = get_engine_move(game_id, engine_type)
-        if analysis:
-            board = game_data['board']
-            move = chess.Move.from_uci(analysis.best_move)
-            board.push(move)
-            game_data['moves'].append(analysis.best_move)
-            response['ai_move'] = analysis.best_move
-            response['fen'] = board.fen()
-            response['analysis'] = asdict(analysis)
+    with game_data['lock']:
+        game_data['current_engine'] = engine_type
+        
+        response = {
+            'game_id': game_id,
+            'fen': game_fen(game_data),
+            'player_color': player_color,
+            'engine_strength': engine_strength,
+            'engine': engine_type
+        }
+        
+        # If the player chose black, the engine makes the first move
+        if player_color == 'black':
+            analysis = get_engine_move(game_id, engine_type)
+            # No best move when the position is already checkmate or stalemate
+            if analysis and analysis.best_move:
+                push_move(game_data, parse_move(analysis.best_move))
+                response['ai_move'] = analysis.best_move
+                response['fen'] = game_fen(game_data)
+                response['analysis'] = analysis.to_dict()
     
     return jsonify(response)
 
 @app.route('/make_move', methods=['POST'])
 def make_move():
     """Processes the player's move and responds with the selected engine"""
-    data = request.json
+    data = json_body()
+    if data is None:
+        return error_response(ERR_JSON_BODY, 400)
     game_id = data.get('game_id', 'default')
     move_uci = data.get('move')
     fen = data.get('fen')  # Optional FEN for synchronization
     engine_type = data.get('engine', 'stockfish')  # Engine to use
     engine_strength = data.get('engine_strength', 20)
     
+    if not valid_strength(engine_strength):
+        return error_response(ERR_STRENGTH_RANGE, 400)
+    
     # Get or create game from FEN
     game_data = get_or_create_game(game_id, fen, engine_strength=engine_strength)
-    game_data['current_engine'] = engine_type
-    board = game_data['board']
     
-    try:
-        move = chess.Move.from_uci(move_uci)
-        if move in board.legal_moves:
-            board.push(move)
-            game_data['moves'].append(move_uci)
-            
-            response = {
-                'success': True,
-                'player_move': move_uci,
-                'fen': board.fen(),
-                'game_over': board.is_game_over(),
-                'moves_history': game_data['moves'],
-                'engine_used': engine_type
-            }
+    # Player move and engine reply must not interleave with other requests on this game
+    with game_data['lock']:
+        game_data['current_engine'] = engine_type
+        board = game_data['board']
+        
+        try:
+            try:
+                move = parse_move(move_uci)
+            except (chess.InvalidMoveError, TypeError):
+                return jsonify({'error': f'Invalid move format: {move_uci!r}', 'fen': game_fen(game_data)}), 400
             
-            if not board.is_game_over():
-                # Use the specified engine
-                analysis = get_engine_move(game_id, engine_type)
+            # Checks this one move instead of generating every legal move
+            if board.is_legal(move):
+                push_move(game_data, move)
+                game_over = board.is_game_over()
+                
+                response = {
+                    'success': True,
+                    'player_move': move_uci,
+                    'fen': game_fen(game_data),
+                    'game_over': game_over,
+                    'moves_history': moves_history(game_data),
+                    'engine_used': engine_type
+                }
                 
-                if analysis:
-                    # Engine makes its move
-                    ai_move = chess.Move.from_uci(analysis.best_move)
-                    board.push(ai_move)
-                    game_data['moves'].append(analysis.best_move)
+                if not game_over:
+                    # Use the specified engine
+                    analysis = get_engine_move(game_id, engine_type)
                     
-                    response['ai_move'] = analysis.best_move
-                    response['fen'] = board.fen()
-                    response['game_over'] = board.is_game_over()
-                    response['analysis'] = asdict(analysis)
-                else:
-                    response['error'] = f'Engine {engine_type} failed to provide move'
-            
-            return jsonify(response)
-        else:
-            return jsonify({'error': 'Illegal move', 'fen': board.fen()}), 400
-            
-    except Exception as e:
-        return jsonify({'error': str(e), 'fen': board.fen() if game_id in games else None}), 400
+                    if analysis and analysis.best_move:
+                        # Engine makes its move
+                        push_move(game_data, parse_move(analysis.best_move))
+                        
+                        response['ai_move'] = analysis.best_move
+                        response['fen'] = game_fen(game_data)
+                        response['moves_history'] = moves_history(game_data)
+                        response['game_over'] = board.is_game_over()
+                        response['analysis'] = analysis.to_dict()
+                    else:
+                        response['error'] = f'Engine {engine_type} failed to provide move'
+                
+                return jsonify(response)
+            else:
+                return jsonify({'error': 'Illegal move', 'fen': game_fen(game_data)}), 400
+                
+        except Exception as e:
+            return jsonify({'error': str(e), 'fen': game_fen(game_data)}), 400
+
+def reply_depth(engine_strength: int) -> int:
+    """Search depth for the engine's reply at a given strength.
+
+    Replies are taken from the first PV line of the search, which Skill
+    Level doesn't touch (it only changes the bestmove Stockfish reports),
+    so this depth limit is what weakens lower strengths: strength 1
+    searches 2 plies, strengths 19 and 20 the full depth of 20.
+    """
+    return max(1, min(20, 1 + engine_strength))
 
 def get_engine_move(game_id: str, engine_type: str) -> Optional[EngineAnalysis]:
     """Gets the move from the specified engine"""
+    if engine_type not in ('stockfish', 'lichess', 'chesscom'):
+        logger.warning("⚠️ Unknown engine type: %s, falling back to Stockfish", engine_type)
+        engine_type = 'stockfish'
+    
     if engine_type == 'stockfish':
-        return analyze_position_stockfish(game_id, top_n=5)
+        game_data = games.get(game_id)
+        strength = game_data['engine_strength'] if game_data is not None else 20
+        return analyze_position_stockfish(game_id, top_n=5, depth=reply_depth(strength))
     elif engine_type == 'lichess':
         return analyze_position_lichess(game_id, top_n=5)
-    elif engine_type == 'chesscom':
-        return analyze_position_chesscom(game_id)
     else:
-        print(f"⚠️ Unknown engine type: {engine_type}, falling back to Stockfish")
-        return analyze_position_stockfish(game_id, top_n=5)
+        return analyze_position_chesscom(game_id)
 
 @app.route('/sync_position', methods=['POST'])
 def sync_position():
     """Synchronizes the board position with the backend (useful after reload)"""
-    data = request.json
+    data = json_body()
+    if data is None:
+        return error_response(ERR_JSON_BODY, 400)
     game_id = data.get('game_id', 'default')
     fen = data.get('fen')
     player_color = data.get('player_color', 'white')
     engine_strength = data.get('engine_strength', 20)
     
     if not fen:
-        return jsonify({'error': 'FEN required'}), 400
+        return error_response(ERR_FEN_REQUIRED, 400)
+    if not valid_strength(engine_strength):
+        return error_response(ERR_STRENGTH_RANGE, 400)
     
     game_data = get_or_create_game(game_id, fen, player_color, engine_strength)
     
-    return jsonify({
-        'success': True,
-        'game_id': game_id,
-        'fen': game_data['board'].fen(),
-        'legal_moves': [m.uci() for m in game_data['board'].legal_moves],
-        'is_game_over': game_data['board'].is_game_over()
-    })
+    with game_data['lock']:
+        board = game_data['board']
+        return jsonify({
+            'success': True,
+            'game_id': game_id,
+            'fen': game_fen(game_data),
+            'legal_moves': [move.uci() for move in legal_moves_meta(board)],
+            'is_game_over': board.is_game_over()
+        })
+
+# Bounds on /analyze_position's top_moves and depth
+MAX_TOP_MOVES = 50
+MAX_DEPTH = 100
 
 @app.route('/analyze_position', methods=['POST'])
 def analyze_position():
     """Analyzes the current position with the chosen engine"""
-    data = request.json
+    data = json_body()
+    if data is None:
+        return error_response(ERR_JSON_BODY, 400)
     game_id = data.get('game_id', 'default')
     engine_type = data.get('engine', 'stockfish')  # stockfish, lichess, chesscom
     top_n = data.get('top_moves', 5)
     depth = data.get('depth', 20)
+    max_time = data.get('max_time', SF_MAX_TIME)  # Seconds per search, 0 = no cap
     fen = data.get('fen')  # Optional FEN
+    stream = data.get('stream', False)  # NDJSON top lines as they arrive (Stockfish only)
+    max_moves = data.get('max_moves')  # Optional cap on all_legal_moves/capture_moves
     
     # Synchronize position if FEN is provided
     if fen:
         get_or_create_game(game_id, fen)
     
     if game_id not in games:
-        return jsonify({'error': 'Game not found and no FEN provided'}), 404
+        return error_response(ERR_GAME_NOT_FOUND_NO_FEN, 404)
+    
+    # Both end up in cache keys and engine limits, so they must be plain ints
+    if not valid_int(top_n, 1, MAX_TOP_MOVES):
+        return error_response(ERR_TOP_MOVES, 400)
+    if not valid_int(depth, 1, MAX_DEPTH):
+        return error_response(ERR_DEPTH, 400)
+    if max_moves is not None and (not isinstance(max_moves, int)
+                                  or isinstance(max_moves, bool) or max_moves < 0):
+        return error_response(ERR_MAX_MOVES, 400)
+    if not valid_seconds(max_time):
+        return error_response(ERR_MAX_TIME, 400)
+    max_time = float(max_time)
+    
+    if stream and engine_type == 'stockfish':
+        game = snapshot_game(game_id)
+        if game is None:
+            return error_response(ERR_GAME_NOT_FOUND_NO_FEN, 404)
+        events = stream_top_lines(game['board'], game['fen'], top_n, depth,
+                                  game['engine_strength'], max_time)
+        # NDJSON unless the client asks for Server-Sent Events
+        if request.accept_mimetypes.best_match(
+                ['application/x-ndjson', 'text/event-stream']) == 'text/event-stream':
+            return Response(sse_messages(events), mimetype='text/event-stream',
+                            headers={'Cache-Control': 'no-cache'})
+        return Response(ndjson_lines(events), mimetype='application/x-ndjson')
     
     if engine_type == 'stockfish':
-        analysis = analyze_position_stockfish(game_id, top_n, depth)
+        analysis = analyze_position_stockfish(game_id, top_n, depth, include_all_moves=True,
+                                              max_time=max_time)
     elif engine_type == 'lichess':
         analysis = analyze_position_lichess(game_id, top_n)
     elif engine_type == 'chesscom':
         analysis = analyze_position_chesscom(game_id)
     else:
-        return jsonify({'error': 'Invalid engine'}), 400
+        return error_response(ERR_INVALID_ENGINE, 400)
     
     if analysis:
-        return jsonify(asdict(analysis))
+        return jsonify(analysis.to_dict(max_moves))
     else:
-        return jsonify({'error': 'Analysis error'}), 500
+        return error_response(ERR_ANALYSIS, 500)
 
-def analyze_position_stockfish(game_id: str, top_n: int = 5, depth: int = 20) -> Optional[EngineAnalysis]:
-    """Analyzes position with local Stockfish - complete analysis"""
-    if game_id not in games:
+# Classified legal moves keyed by position, shared by every game and analyzer
+LEGAL_MOVES_CACHE_SIZE = 8192
+legal_moves_cache = LRUCache(LEGAL_MOVES_CACHE_SIZE)
+
+def legal_moves_meta(board: chess.Board) -> Dict[chess.Move, tuple]:
+    """Cached classify_legal_moves() of a position, as
+    {move: (is_capture, piece, from, to)} in generation order.
+
+    /legal_moves, /analyze_position and /compare_engines tend to hit the
+    same positions back to back, so move generation and the per-move
+    classification run once per position. Callers must not modify the
+    returned dict.
+    """
+    key = position_key(board)
+    details = legal_moves_cache.get(key)
+    if details is None:
+        details = {move: tuple(rest) for move, *rest in classify_legal_moves(board)}
+        legal_moves_cache.put(key, details)
+    return details
+
+def search_limit(depth: int, max_time: Optional[float] = None) -> chess.engine.Limit:
+    """Depth limit, capped in time by max_time (seconds, 0 = no cap)"""
+    return chess.engine.Limit(depth=depth, time=max_time or None)
+
+def search_top_lines(engine: chess.engine.SimpleEngine, board: chess.Board,
+                     depth: int, multipv: int, max_time: Optional[float] = None) -> List[Dict]:
+    """Multi-PV search that stops as soon as every line reached the target depth"""
+    expected = min(multipv, len(legal_moves_meta(board)))
+    lines = {}  # multipv index -> latest info for that line
+    with engine.analysis(board, search_limit(depth, max_time), multipv=multipv) as analysis:
+        for info in analysis:
+            if 'pv' not in info:
+                continue
+            lines[info.get('multipv', 1)] = info
+            # Leaving the block sends "stop" instead of waiting for bestmove
+            if len(lines) >= expected and all(l.get('depth', 0) >= depth for l in lines.values()):
+                break
+    return [lines[i] for i in sorted(lines)]
+
+def score_fields(score: chess.engine.Score) -> tuple:
+    """(evaluation, is_mate, mate_in) of a score relative to the side to move"""
+    if score.is_mate():
+        mate_in = score.mate()
+        return (10000 if mate_in > 0 else -10000), True, mate_in
+    return score.score(), False, None
+
+def pv_move_evaluation(board: chess.Board, pv_info: Dict) -> MoveEvaluation:
+    """MoveEvaluation for the first move of a principal variation"""
+    move = pv_info['pv'][0]
+    is_capture, piece, from_name, to_name = legal_moves_meta(board)[move]
+    eval_score, is_mate, mate_in = score_fields(pv_info['score'].relative)
+    
+    return MoveEvaluation(
+        move=move.uci(),
+        evaluation=eval_score,
+        is_mate=is_mate,
+        mate_in=mate_in,
+        is_capture=is_capture,
+        piece=piece,
+        from_square=from_name,
+        to_square=to_name
+    )
+
+def stream_top_lines(board: chess.Board, fen: str, top_n: int, depth: int, engine_strength: int,
+                     max_time: float = SF_MAX_TIME) -> Iterator[Dict]:
+    """Yields an event dict for each Stockfish line as soon as it improves.
+
+    Every event carries the multipv index and the depth reached, so the
+    client can replace earlier (shallower) results for the same index.
+    The last event has "done": true and the best move of the search.
+    """
+    expected = min(top_n, len(legal_moves_meta(board)))
+    depths = {}  # multipv index -> deepest depth already sent
+    best_move = None
+    try:
+        with engine_pool.acquire(engine_strength) as engine:
+            with engine.analysis(board, search_limit(depth, max_time), multipv=top_n) as analysis:
+                for info in analysis:
+                    if 'pv' not in info:
+                        continue
+                    index = info.get('multipv', 1)
+                    line_depth = info.get('depth', 0)
+                    if depths.get(index, -1) >= line_depth:
+                        continue
+                    depths[index] = line_depth
+                    move_eval = pv_move_evaluation(board, info)
+                    if index == 1:
+                        best_move = move_eval.move
+                    yield {
+                        'multipv': index,
+                        'depth': line_depth,
+                        'move': move_eval.to_dict()
+                    }
+                    if len(depths) >= expected and all(d >= depth for d in depths.values()):
+                        break
+    except Exception:
+        logger.exception("Error with Stockfish")
+        yield {'error': 'Analysis error', 'done': True}
+        return
+    yield {'done': True, 'best_move': best_move, 'fen': fen}
+
+def ndjson_lines(events) -> Iterator[str]:
+    """Formats events as newline-delimited JSON"""
+    for event in events:
+        yield json.dumps(event) + '\n'
+
+def sse_messages(events) -> Iterator[str]:
+    """Formats events as Server-Sent Events data messages"""
+    for event in events:
+        yield 'data: ' + json.dumps(event) + '\n\n'
+
+def unevaluated_moves(board: chess.Board, captures_only: bool = False) -> List[MoveEvaluation]:
+    """Every legal move (or just the captures) with its metadata but no engine evaluation"""
+    return [
+        MoveEvaluation(
+            move=move.uci(),
+            evaluation=0,
+            is_mate=False,
+            mate_in=None,
+            is_capture=is_capture,
+            piece=piece,
+            from_square=from_name,
+            to_square=to_name
+        )
+        for move, (is_capture, piece, from_name, to_name) in legal_moves_meta(board).items()
+        if is_capture or not captures_only
+    ]
+
+def terminal_analysis(board: chess.Board, fen: str) -> EngineAnalysis:
+    """Analysis of a position without legal moves (checkmate or stalemate)"""
+    position_eval = 0
+    if board.is_checkmate():
+        # The side to move is mated; evaluations are from white's perspective
+        position_eval = -10000 if board.turn == chess.WHITE else 10000
+    return EngineAnalysis(
+        best_move=None,
+        top_moves=[],
+        all_legal_moves=[],
+        capture_moves=[],
+        position_evaluation=position_eval,
+        fen=fen
+    )
+
+def analyze_position_stockfish(game_id: str, top_n: int = 5, depth: int = 20,
+                               include_all_moves: bool = False,
+                               max_time: float = SF_MAX_TIME) -> Optional[EngineAnalysis]:
+    """Analyzes position with local Stockfish.
+
+    Only with include_all_moves are all legal moves scored by the engine;
+    otherwise they are listed unevaluated (like the Lichess analysis),
+    which saves a multi-PV search over every move when only the best
+    move is needed.
+    """
+    # Work on a copy so a concurrent sync can't change the board mid-search
+    game = snapshot_game(game_id)
+    if game is None:
         return None
     
-    board = games[game_id]['board']
-    engine_strength = games[game_id].get('engine_strength', 20)
+    board = game['board']
+    engine_strength = game['engine_strength']
     
+    cache_key = ('stockfish', position_key(board), depth, top_n, max_time,
+                 engine_strength, engine_pool.engine_name, True)
+    if not include_all_moves:
+        # A complete analysis answers a partial request just as well
+        full = analysis_cache.get(cache_key, count_miss=False)
+        if full is not None:
+            return replace(full, fen=game['fen'])
+        cache_key = cache_key[:-1] + (False,)
+    return cached_analysis(
+        cache_key, game['fen'],
+        lambda: _stockfish_analysis(board, game['fen'], top_n, depth, engine_strength,
+                                    include_all_moves, max_time))
+
+def _stockfish_analysis(board: chess.Board, fen: str, top_n: int, depth: int,
+                        engine_strength: int, include_all_moves: bool,
+                        max_time: float) -> Optional[EngineAnalysis]:
+    """Runs the Stockfish analysis of a board (uncached)"""
+    move_count = len(legal_moves_meta(board))
+    if move_count == 0:
+        # Nothing to search: the result is known without the engine
+        return terminal_analysis(board, fen)
+    if move_count == 1:
+        # Forced move: a shallow search still scores it, going deeper
+        # can't change which move gets played
+        depth = min(depth, 10)
     try:
-        with chess.engine.SimpleEngine.popen_uci(STOCKFISH_PATH) as engine:
-            # Configure engine strength (Skill Level 0-20)
-            engine.configure({"Skill Level": engine_strength})
-            
+        # Borrow a pooled engine configured with the game strength (Skill Level 0-20)
+        with engine_pool.acquire(engine_strength) as engine:
             # Multi-PV analysis to get top N moves
-            info = engine.analyse(
-                board, 
-                chess.engine.Limit(depth=depth),
-                multipv=top_n
-            )
+            info = search_top_lines(engine, board, depth, top_n, max_time)
             
-            top_moves = []
-            for pv_info in info:
-                move = pv_info['pv'][0]
-                score = pv_info['score'].relative
-                
-                eval_score = 0
-                is_mate = False
-                mate_in = None
-                
-                if score.is_mate():
-                    is_mate = True
-                    mate_in = score.mate()
-                    eval_score = 10000 if mate_in > 0 else -10000
-                else:
-                    eval_score = score.score()
-                
-                top_moves.append(MoveEvaluation(
-                    move=move.uci(),
-                    evaluation=eval_score,
-                    is_mate=is_mate,
-                    mate_in=mate_in,
-                    is_capture=board.is_capture(move),
-                    piece=board.piece_at(move.from_square).symbol(),
-                    from_square=chess.square_name(move.from_square),
-                    to_square=chess.square_name(move.to_square)
-                ))
+            top_moves = [pv_move_evaluation(board, pv_info) for pv_info in info]
             
-            # Analyze ALL legal moves
-            all_moves = []
-            for move in board.legal_moves:
-                board.push(move)
-                eval_info = engine.analyse(board, chess.engine.Limit(depth=10))
-                board.pop()
+            if include_all_moves:
+                # Analyze ALL legal moves with a single shallow multi-PV search:
+                # one line per root move, scored from the side to move
+                details = dict(legal_moves_meta(board))  # Copy: entries are popped below
+                sweep = search_top_lines(engine, board, 10, len(details), max_time) if details else []
                 
-                score = eval_info['score'].relative
-                eval_score = 0
-                is_mate = False
-                mate_in = None
+                all_moves = []
+                for pv_info in sweep:
+                    move = pv_info['pv'][0]
+                    # pop(): lines cut short by the time cap can repeat a move
+                    meta = details.pop(move, None)
+                    if meta is None:
+                        continue
+                    is_capture, piece, from_name, to_name = meta
+                    eval_score, is_mate, mate_in = score_fields(pv_info['score'].relative)
+                    all_moves.append(MoveEvaluation(
+                        move=move.uci(),
+                        evaluation=eval_score,
+                        is_mate=is_mate,
+                        mate_in=mate_in,
+                        is_capture=is_capture,
+                        piece=piece,
+                        from_square=from_name,
+                        to_square=to_name
+                    ))
                 
-                if score.is_mate():
-                    is_mate = True
-                    mate_in = score.mate()
-                    eval_score = 10000 if mate_in > 0 else -10000
-                else:
-                    eval_score = -score.score()  # Invert because it's relative to opponent
+                # Moves the search never reported a line for (time cap hit
+                # first) rank last, scored like the worst move it did see
+                floor = min((m.evaluation for m in all_moves), default=0)
+                for move, (is_capture, piece, from_name, to_name) in details.items():
+                    all_moves.append(MoveEvaluation(
+                        move=move.uci(),
+                        evaluation=floor,
+                        is_mate=False,
+                        mate_in=None,
+                        is_capture=is_capture,
+                        piece=piece,
+                        from_square=from_name,
+                        to_square=to_name
+                    ))
                 
-                all_moves.append(MoveEvaluation(
-                    move=move.uci(),
-                    evaluation=eval_score,
-                    is_mate=is_mate,
-                    mate_in=mate_in,
-                    is_capture=board.is_capture(move),
-                    piece=board.piece_at(move.from_square).symbol(),
-                    from_square=chess.square_name(move.from_square),
-                    to_square=chess.square_name(move.to_square)
-                ))
-            
-            # Filter capture moves
+                # Sort all moves by evaluation; filtering the sorted list keeps
+                # the captures in the same order without a second sort
+                all_moves.sort(key=BY_EVALUATION, reverse=True)
+            else:
+                all_moves = unevaluated_moves(board)
             capture_moves = [m for m in all_moves if m.is_capture]
             
-            # Sort all moves by evaluation
-            all_moves.sort(key=lambda x: x.evaluation, reverse=True)
-            capture_moves.sort(key=lambda x: x.evaluation, reverse=True)
-            
-            # Position evaluation (ALWAYS from white's perspective)
-            main_eval = engine.analyse(board, chess.engine.Limit(depth=depth))
-            position_eval = 0
-            if main_eval['score'].relative.is_mate():
-                mate_score = main_eval['score'].relative.mate()
-                position_eval = 10000 if mate_score > 0 else -10000
-            else:
-                position_eval = main_eval['score'].relative.score()
+            # Position evaluation (ALWAYS from white's perspective), taken
+            # from the best line of the full-depth search
+            position_eval = top_moves[0].evaluation
             
             # If it's black's turn, invert the evaluation to be from white's perspective
             if board.turn == chess.BLACK:
                 position_eval = -position_eval
             
-            return EngineAnalysis(
+            analysis = EngineAnalysis(
                 best_move=top_moves[0].move,
                 top_moves=top_moves,
                 all_legal_moves=all_moves,
                 capture_moves=capture_moves,
                 position_evaluation=position_eval,
-                fen=board.fen()
+                fen=fen
             )
+            return analysis
             
-    except Exception as e:
-        print(f"Error with Stockfish: {e}")
+    except Exception:
+        logger.exception("Error with Stockfish")
         return None
 
+# Cloud evaluations deepen over time, so cached ones are refreshed hourly
+LICHESS_CACHE_TTL = 3600
+# Positions Lichess has no evaluation for (or failed lookups) aren't asked
+# again for a minute: unknown positions would otherwise cost a round trip
+# on every request
+LICHESS_MISS_TTL = 60
+lichess_misses = LRUCache(ANALYSIS_CACHE_SIZE)  # (position, top_n) -> time of the miss
+
 def analyze_position_lichess(game_id: str, top_n: int = 5) -> Optional[EngineAnalysis]:
     """Analyzes position using Lichess Cloud Evaluation API"""
-    if game_id not in games:
+    game = snapshot_game(game_id)
+    if game is None:
         return None
     
-    board = games[game_id]['board']
-    fen = board.fen()
+    board = game['board']
+    key = position_key(board)
+    now = time.monotonic()
+    missed_at = lichess_misses.get((key, top_n))
+    if missed_at is not None and now - missed_at < LICHESS_MISS_TTL:
+        return None
+    
+    cache_key = ('lichess', key, None, top_n)
+    fen = game['fen']
+    analysis = cached_analysis(cache_key, fen, lambda: _lichess_analysis(board, fen, top_n),
+                               max_age=LICHESS_CACHE_TTL)
+    if analysis is None:
+        lichess_misses.put((key, top_n), now)
+    return analysis
+
+def _fetch_lichess(fen: str, top_n: int) -> Optional[Dict]:
+    """Cloud evaluation JSON for a FEN, or None if Lichess has none"""
+    # Lichess Cloud Eval API
+    url = "https://lichess.org/api/cloud-eval"
+    params = {
+        'fen': fen,
+        'multiPv': top_n
+    }
+    
+    # (connect, read) timeouts; the connection itself is reused
+    response = http_session.get(url, params=params, timeout=(2, 5))
     
+    if response.status_code == 200:
+        data = response.json()
+        if data.get('pvs'):
+            return data
+    return None
+
+def _lichess_analysis(board: chess.Board, fen: str, top_n: int) -> Optional[EngineAnalysis]:
+    """Builds the analysis of a board from its Lichess cloud evaluation (uncached)"""
+    if not legal_moves_meta(board):
+        return terminal_analysis(board, fen)
     try:
-        # Lichess Cloud Eval API
-        url = "https://lichess.org/api/cloud-eval"
-        params = {
-            'fen': fen,
-            'multiPv': top_n
-        }
+        data = _fetch_lichess(fen, top_n)
         
-        response = requests.get(url, params=params, timeout=10)
-        
-        if response.status_code == 200:
-            data = response.json()
-            
-            if 'pvs' not in data or len(data['pvs']) == 0:
-                return None
-            
+        if data is not None:
+            details = legal_moves_meta(board)
             top_moves = []
             for pv in data['pvs']:
-                move_uci = pv['moves'].split()[0]
-                move = chess.Move.from_uci(move_uci)
+                try:
+                    # parse_uci also normalizes king-takes-rook castling (e1h1)
+                    move = board.parse_uci(pv['moves'].split()[0])
+                except ValueError:
+                    continue
+                move_uci = move.uci()
+                is_capture, piece, from_name, to_name = details[move]
                 
                 cp = pv.get('cp')
                 mate = pv.get('mate')
@@ -968,31 +1221,20 @@ def analyze_position_lichess(game_id: str, top_n: int = 5) -> Optional[EngineAna
                     evaluation=eval_score,
                     is_mate=is_mate,
                     mate_in=mate_in,
-                    is_capture=board.is_capture(move),
-                    piece=board.piece_at(move.from_square).symbol(),
-                    from_square=chess.square_name(move.from_square),
-                    to_square=chess.square_name(move.to_square)
+                    is_capture=is_capture,
+                    piece=piece,
+                    from_square=from_name,
+                    to_square=to_name
                 ))
             
             # For Lichess, we generate all legal moves without deep evaluation
-            all_moves = []
-            for move in board.legal_moves:
-                all_moves.append(MoveEvaluation(
-                    move=move.uci(),
-                    evaluation=0,  # Lichess doesn't evaluate all moves
-                    is_mate=False,
-                    mate_in=None,
-                    is_capture=board.is_capture(move),
-                    piece=board.piece_at(move.from_square).symbol(),
-                    from_square=chess.square_name(move.from_square),
-                    to_square=chess.square_name(move.to_square)
-                ))
+            all_moves = unevaluated_moves(board)
             
             capture_moves = [m for m in all_moves if m.is_capture]
             
             position_eval = top_moves[0].evaluation if top_moves else 0
             
-            return EngineAnalysis(
+            analysis = EngineAnalysis(
                 best_move=top_moves[0].move,
                 top_moves=top_moves,
                 all_legal_moves=all_moves,
@@ -1000,99 +1242,70 @@ def analyze_position_lichess(game_id: str, top_n: int = 5) -> Optional[EngineAna
                 position_evaluation=position_eval,
                 fen=fen
             )
+            return analysis
         
         return None
         
     except Exception as e:
-        print(f"Error with Lichess: {e}")
+        # Network failures are expected (offline, rate limits): no traceback
+        logger.warning("Error with Lichess: %s", e)
         return None
 
 def analyze_position_chesscom(game_id: str) -> Optional[EngineAnalysis]:
     """Analyzes position using Chess.com - basic implementation with Stockfish"""
-    if game_id not in games:
+    game = snapshot_game(game_id)
+    if game is None:
         return None
     
-    board = games[game_id]['board']
-    
+    board = game['board']
+    cache_key = ('chesscom', position_key(board), 15, 3, 20, engine_pool.engine_name)
+    return cached_analysis(cache_key, game['fen'], lambda: _chesscom_analysis(board, game['fen']))
+
+def _chesscom_analysis(board: chess.Board, fen: str) -> Optional[EngineAnalysis]:
+    """Runs the Chess.com-style quick analysis of a board (uncached)"""
+    if not legal_moves_meta(board):
+        return terminal_analysis(board, fen)
     # Chess.com doesn't have a public direct analysis API
     # Use Stockfish as fallback but with different configuration
     try:
-        with chess.engine.SimpleEngine.popen_uci(STOCKFISH_PATH) as engine:
+        with engine_pool.acquire() as engine:
             # Quick analysis
-            info = engine.analyse(board, chess.engine.Limit(depth=15), multipv=3)
+            info = search_top_lines(engine, board, 15, 3)
             
-            top_moves = []
-            for pv_info in info:
-                move = pv_info['pv'][0]
-                score = pv_info['score'].relative
-                
-                eval_score = 0
-                is_mate = False
-                mate_in = None
-                
-                if score.is_mate():
-                    is_mate = True
-                    mate_in = score.mate()
-                    eval_score = 10000 if mate_in > 0 else -10000
-                else:
-                    eval_score = score.score()
-                
-                top_moves.append(MoveEvaluation(
-                    move=move.uci(),
-                    evaluation=eval_score,
-                    is_mate=is_mate,
-                    mate_in=mate_in,
-                    is_capture=board.is_capture(move),
-                    piece=board.piece_at(move.from_square).symbol(),
-                    from_square=chess.square_name(move.from_square),
-                    to_square=chess.square_name(move.to_square)
-                ))
+            top_moves = [pv_move_evaluation(board, pv_info) for pv_info in info]
             
-            all_moves = []
-            for move in board.legal_moves:
-                all_moves.append(MoveEvaluation(
-                    move=move.uci(),
-                    evaluation=0,
-                    is_mate=False,
-                    mate_in=None,
-                    is_capture=board.is_capture(move),
-                    piece=board.piece_at(move.from_square).symbol(),
-                    from_square=chess.square_name(move.from_square),
-                    to_square=chess.square_name(move.to_square)
-                ))
+            all_moves = unevaluated_moves(board)
             
             capture_moves = [m for m in all_moves if m.is_capture]
             
-            # Position evaluation (ALWAYS from white's perspective)
-            main_eval = engine.analyse(board, chess.engine.Limit(depth=15))
-            position_eval = 0
-            if main_eval['score'].relative.is_mate():
-                mate_score = main_eval['score'].relative.mate()
-                position_eval = 10000 if mate_score > 0 else -10000
-            else:
-                position_eval = main_eval['score'].relative.score()
+            # Position evaluation (ALWAYS from white's perspective), taken
+            # from the best line of the same depth-15 search
+            position_eval = top_moves[0].evaluation if top_moves else 0
             
             # If it's black's turn, invert for white's perspective
             if board.turn == chess.BLACK:
                 position_eval = -position_eval
             
-            return EngineAnalysis(
+            analysis = EngineAnalysis(
                 best_move=top_moves[0].move if top_moves else None,
                 top_moves=top_moves,
                 all_legal_moves=all_moves,
                 capture_moves=capture_moves,
                 position_evaluation=position_eval,
-                fen=board.fen()
+                fen=fen
             )
+            return analysis
         
-    except Exception as e:
-        print(f"Error with Chess.com fallback: {e}")
+    except Exception:
+        logger.exception("Error with Chess.com fallback")
         return None
 
 @app.route('/set_engine_strength', methods=['POST'])
 def set_engine_strength():
     """Changes the engine strength (1-20)"""
-    data = request.json
+    data = json_body()
+    if data is None:
+        return error_response(ERR_JSON_BODY, 400)
     game_id = data.get('game_id', 'default')
     strength = data.get('strength', 20)
     fen = data.get('fen')  # Optional FEN
@@ -1101,13 +1314,15 @@ def set_engine_strength():
     if fen:
         get_or_create_game(game_id, fen)
     
-    if game_id not in games:
-        return jsonify({'error': 'Game not found'}), 404
+    game_data = games.get(game_id)
+    if game_data is None:
+        return error_response(ERR_GAME_NOT_FOUND, 404)
     
-    if not 1 <= strength <= 20:
-        return jsonify({'error': 'Strength must be between 1 and 20'}), 400
+    if not valid_strength(strength):
+        return error_response(ERR_STRENGTH_RANGE, 400)
     
-    games[game_id]['engine_strength'] = strength
+    with game_data['lock']:
+        game_data['engine_strength'] = strength
     
     return jsonify({
         'success': True,
@@ -1115,34 +1330,64 @@ def set_engine_strength():
         'message': f'Engine strength set to {strength}/20'
     })
 
+def position_etag(board: chess.Board, *params) -> str:
+    """Validator for GET responses that depend only on the position (and params)"""
+    # The key is plain ints, so its repr is stable across processes; hashing
+    # also keeps characters not allowed in an ETag (engine names) out of it
+    etag = hashlib.md5(repr(position_key(board)).encode()).hexdigest()[:16]
+    if params:
+        etag += '-' + hashlib.md5(repr(params).encode()).hexdigest()[:12]
+    return etag
+
+def with_etag(response: Response, etag: str) -> Response:
+    """Tags a response so polling clients can revalidate with If-None-Match"""
+    response.set_etag(etag, weak=True)
+    # Always revalidate: the same URL serves a new position after a move
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+def not_modified(etag: str) -> Response:
+    """Empty 304 answer for a client whose copy is still current"""
+    return with_etag(Response(status=304), etag)
+
 @app.route('/get_capture_moves', methods=['GET'])
 def get_capture_moves():
     """Returns only capture moves with evaluation"""
     game_id = request.args.get('game_id', 'default')
     engine = request.args.get('engine', 'stockfish')
     fen = request.args.get('fen')  # Optional FEN
+    # Stockfish scores the captures unless evaluate=false: listing them needs no search
+    evaluate = request.args.get('evaluate', 'true').lower() != 'false'
     
     # Synchronize if FEN is provided
     if fen:
         get_or_create_game(game_id, fen)
     
-    if game_id not in games:
-        return jsonify({'error': 'Game not found'}), 404
+    game_data = games.get(game_id)
+    if game_data is None:
+        return error_response(ERR_GAME_NOT_FOUND, 404)
     
-    if engine == 'stockfish':
-        analysis = analyze_position_stockfish(game_id, top_n=5)
-    elif engine == 'lichess':
-        analysis = analyze_position_lichess(game_id, top_n=5)
-    else:
-        analysis = analyze_position_chesscom(game_id)
+    scored = engine == 'stockfish' and evaluate
+    with game_data['lock']:
+        etag = position_etag(game_data['board'], engine, evaluate,
+                             game_data.get('engine_strength', 20), engine_pool.engine_name)
+        if not scored:
+            # Every other engine lists captures unevaluated, which only takes
+            # the position's move table: no search and no Lichess round trip
+            capture_moves = unevaluated_moves(game_data['board'], captures_only=True)
+    if request.if_none_match.contains_weak(etag):
+        return not_modified(etag)
     
-    if analysis:
-        return jsonify({
-            'capture_moves': [asdict(m) for m in analysis.capture_moves],
-            'total_captures': len(analysis.capture_moves)
-        })
+    if scored:
+        analysis = analyze_position_stockfish(game_id, top_n=5, include_all_moves=True)
+        if not analysis:
+            return error_response(ERR_ANALYSIS, 500)
+        capture_moves = analysis.capture_moves
     
-    return jsonify({'error': 'Analysis error'}), 500
+    return with_etag(jsonify({
+        'capture_moves': [m.to_dict() for m in capture_moves],
+        'total_captures': len(capture_moves)
+    }), etag)
 
 @app.route('/legal_moves', methods=['GET'])
 def legal_moves():
@@ -1155,28 +1400,37 @@ def legal_moves():
     if fen:
         get_or_create_game(game_id, fen)
     
-    if game_id not in games:
-        return jsonify({'error': 'Game not found'}), 404
+    game_data = games.get(game_id)
+    if game_data is None:
+        return error_response(ERR_GAME_NOT_FOUND, 404)
+    
+    with game_data['lock']:
+        board = game_data['board']
+        etag = position_etag(board)
+        details = legal_moves_meta(board) if square else {}
+    if request.if_none_match.contains_weak(etag):
+        return not_modified(etag)
     
-    board = games[game_id]['board']
     legal = []
     
     if square:
-        square_idx = chess.parse_square(square)
-        for move in board.legal_moves:
+        square_idx = parse_square(square)
+        for move, (is_capture, _, _, to_name) in details.items():
             if move.from_square == square_idx:
                 legal.append({
-                    'to': chess.square_name(move.to_square),
+                    'to': to_name,
                     'move': move.uci(),
-                    'is_capture': board.is_capture(move)
+                    'is_capture': is_capture
                 })
     
-    return jsonify({'legal_moves': legal})
+    return with_etag(jsonify({'legal_moves': legal}), etag)
 
 @app.route('/compare_engines', methods=['POST'])
 def compare_engines():
     """Compares the best move from different engines"""
-    data = request.json
+    data = json_body()
+    if data is None:
+        return error_response(ERR_JSON_BODY, 400)
     game_id = data.get('game_id', 'default')
     fen = data.get('fen')  # Optional FEN
     
@@ -1185,30 +1439,90 @@ def compare_engines():
         get_or_create_game(game_id, fen)
     
     if game_id not in games:
-        return jsonify({'error': 'Game not found'}), 404
+        return error_response(ERR_GAME_NOT_FOUND, 404)
     
     results = {}
     
+    # Lichess waits on the network while Stockfish searches, so run it alongside
+    li_future = background_executor.submit(analyze_position_lichess, game_id, 3)
+    
     # Stockfish
     sf_analysis = analyze_position_stockfish(game_id, top_n=3)
     if sf_analysis:
         results['stockfish'] = {
             'best_move': sf_analysis.best_move,
             'evaluation': sf_analysis.position_evaluation,
-            'top_3': [asdict(m) for m in sf_analysis.top_moves[:3]]
+            'top_3': [m.to_dict() for m in sf_analysis.top_moves[:3]]
         }
     
     # Lichess
-    li_analysis = analyze_position_lichess(game_id, top_n=3)
+    li_analysis = li_future.result()
     if li_analysis:
         results['lichess'] = {
             'best_move': li_analysis.best_move,
             'evaluation': li_analysis.position_evaluation,
-            'top_3': [asdict(m) for m in li_analysis.top_moves[:3]]
+            'top_3': [m.to_dict() for m in li_analysis.top_moves[:3]]
         }
     
     return jsonify(results)
 
+# Upper bound on the positions of one /batch_analyze request
+BATCH_MAX_GAMES = 50
+# Lichess cloud evaluations store at most 5 lines per position
+BATCH_MAX_TOP_MOVES = 5
+
+@app.route('/batch_analyze', methods=['POST'])
+def batch_analyze():
+    """Analyzes several games with Lichess, fetching them concurrently"""
+    data = json_body()
+    if data is None:
+        return error_response(ERR_JSON_BODY, 400)
+    game_ids = data.get('game_ids')
+    top_n = data.get('top_moves', 5)
+    
+    if (not isinstance(game_ids, list) or not game_ids
+            or not all(isinstance(game_id, str) for game_id in game_ids)):
+        return error_response(ERR_GAME_IDS_REQUIRED, 400)
+    if len(game_ids) > BATCH_MAX_GAMES:
+        return error_response(ERR_BATCH_TOO_LARGE, 400)
+    if not valid_int(top_n, 1, BATCH_MAX_TOP_MOVES):
+        return error_response(ERR_BATCH_TOP_MOVES, 400)
+    
+    # The lookups only wait on the network, so they overlap on the worker
+    # threads; cached positions return without a request
+    analyses = background_executor.map(analyze_position_lichess, game_ids,
+                                       [top_n] * len(game_ids))
+    
+    results = []
+    for game_id, analysis in zip(game_ids, analyses):
+        if analysis:
+            results.append({'game_id': game_id, 'analysis': analysis.to_dict()})
+        elif game_id in games:
+            results.append({'game_id': game_id, 'error': 'Analysis error'})
+        else:
+            results.append({'game_id': game_id, 'error': 'Game not found'})
+    
+    return jsonify({'results': results})
+
+@app.route('/cache_stats', methods=['GET'])
+def cache_stats():
+    """Reports hit/miss statistics of the server caches"""
+    return jsonify({
+        'analysis_cache': analysis_cache.info(),
+        'legal_moves_cache': legal_moves_cache.info(),
+        'lichess_miss_cache': lichess_misses.info(),
+        'fen_cache': _board_from_fen.cache_info()._asdict()
+    })
+
+@app.route('/cache_clear', methods=['POST'])
+def cache_clear():
+    """Empties the server caches"""
+    analysis_cache.clear()
+    legal_moves_cache.clear()
+    lichess_misses.clear()
+    _board_from_fen.cache_clear()
+    return jsonify({'success': True})
+
 @app.route('/')
 def home():
     """Home page with API information"""
@@ -1225,7 +1539,10 @@ def home():
             'set_engine_strength': 'POST /set_engine_strength',
             'get_capture_moves': 'GET /get_capture_moves',
             'legal_moves': 'GET /legal_moves',
-            'compare_engines': 'POST /compare_engines'
+            'compare_engines': 'POST /compare_engines',
+            'batch_analyze': 'POST /batch_analyze',
+            'cache_stats': 'GET /cache_stats',
+            'cache_clear': 'POST /cache_clear'
         }
     })
 
@@ -1252,9 +1569,41 @@ if __name__ == '__main__':
     print("  GET  /get_capture_moves - Captures only (supports FEN)")
     print("  GET  /legal_moves - Legal moves (supports FEN)")
     print("  POST /compare_engines - Compare engines (supports FEN)")
+    print("  POST /batch_analyze - Lichess analysis of several games")
+    print("  GET  /cache_stats - Cache hit/miss statistics")
+    print("  POST /cache_clear - Empty the caches")
     print("\n💡 Quick Start:")
     print("  1. Install dependencies: pip install flask-swagger-ui")
     print("  2. Visit http://localhost:5000/api/docs to test the API")
     print("  3. Try the endpoints directly from the Swagger interface")
     print("=" * 60)
-    app.run(debug=True, port=5000)
\ No newline at end of file
+    # The banner above is console output; problems go through the logger
+    # --dev keeps Flask's debugger and auto-reloader; otherwise serve with
+    # waitress (when installed), which has no per-request debug overhead
+    dev_mode = '--dev' in sys.argv
+    # With the reloader the script also runs in the file-watcher process;
+    # only the child process that serves requests needs warm engines
+    if not dev_mode or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        try:
+            engine_pool.warm_up()
+            print(f"🔥 {engine_pool.size} Stockfish engine(s) ready")
+        except Exception as e:
+            logger.warning("⚠️ Could not start Stockfish: %s", e)
+    try:
+        if dev_mode:
+            # Flask's default, spelled out: each request gets its own thread, so
+            # slow engine searches and Lichess calls don't block other clients
+            # (the engine pool bounds CPU use)
+            app.run(debug=True, port=5000, threaded=True)
+        else:
+            try:
+                from waitress import serve
+            except ImportError:
+                logger.warning("⚠️ waitress not installed, using Flask's built-in server")
+                app.run(port=5000, threaded=True)
+            else:
+                serve(app, host='127.0.0.1', port=5000,
+                      threads=min(32, (os.cpu_count() or 4) * 4))
+    finally:
+        # Engine processes keep background threads alive; stop them on shutdown
+        engine_pool.close()
@@ -0,0 +1,37 @@
+"""gunicorn settings for the chess API: gunicorn -c gunicorn.conf.py wsgi:app
+
+Games live in each worker's memory, so with more than one worker a
+game_id only keeps its state if every request for it sends the FEN.
+The default is therefore a single worker with many threads; raise
+WEB_CONCURRENCY when clients always sync by FEN.
+"""
+import os
+import sys
+
+bind = os.environ.get('BIND', '127.0.0.1:5000')
+workers = int(os.environ.get('WEB_CONCURRENCY', '1'))
+worker_class = 'gthread'
+threads = min(32, (os.cpu_count() or 4) * 4)
+# Deep searches can take a while; don't let the arbiter kill busy workers
+timeout = 120
+
+# Every worker owns its own Stockfish pool: split the backend's default
+# pool (at most 4 engines, see DEFAULT_POOL_MAX) between them, so adding
+# workers doesn't multiply the engines' hash memory, and split the engine
+# cores between all engines so the total stays at one search thread per
+# core. Pinning is per process, so several workers would pin to the same
+# cores
+_engine_cores = max(1, (os.cpu_count() or 1) - 1)
+_pool_size = max(1, min(4, _engine_cores) // workers)
+os.environ.setdefault('STOCKFISH_POOL_SIZE', str(_pool_size))
+os.environ.setdefault('STOCKFISH_THREADS',
+                      str(max(1, _engine_cores // (_pool_size * workers))))
+if workers > 1:
+    os.environ.setdefault('STOCKFISH_PIN_CORES', '0')
+
+
+def worker_exit(server, worker):
+    """Quits the worker's engines (their reader threads block exit otherwise)"""
+    backend = sys.modules.get('chess_api_backend')
+    if backend is not None:
+        backend.engine_pool.close()
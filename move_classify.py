@@ -0,0 +1,48 @@
+"""Per-move classification used by the analyzers and /legal_moves.
+
+Kept in its own fully typed module so it can be compiled ahead of time
+with mypyc (``mypyc move_classify.py``). The compiled extension is
+picked up automatically by ``import move_classify``; without it the
+plain Python module is used.
+"""
+from typing import List, Tuple
+
+import chess
+
+MoveDetails = Tuple[chess.Move, bool, str, str, str]
+
+# Lookup tables built once, so the per-move loop only indexes tuples
+SQUARE_NAMES: Tuple[str, ...] = tuple(chess.SQUARE_NAMES)
+# PIECE_LETTERS[color][piece_type], e.g. PIECE_LETTERS[chess.WHITE][chess.KNIGHT] == 'N'
+PIECE_LETTERS: Tuple[Tuple[str, ...], ...] = (
+    ('',) + tuple(chess.piece_symbol(t) for t in chess.PIECE_TYPES),
+    ('',) + tuple(chess.piece_symbol(t).upper() for t in chess.PIECE_TYPES),
+)
+
+
+def classify_legal_moves(board: chess.Board) -> List[MoveDetails]:
+    """Returns (move, is_capture, piece, from, to) for every legal move.
+
+    Captures are detected with one bitboard test against the opponent's
+    pieces (plus the en passant square for pawns) instead of calling
+    board.is_capture()/board.piece_at() per move.
+    """
+    them: int = board.occupied_co[not board.turn]
+    pawns: int = board.pawns
+    ep_square: int = -1 if board.ep_square is None else board.ep_square
+    letters: Tuple[str, ...] = PIECE_LETTERS[board.turn]
+
+    details: List[MoveDetails] = []
+    for move in board.generate_legal_moves():
+        from_square: int = move.from_square
+        to_square: int = move.to_square
+        is_capture: bool = bool(chess.BB_SQUARES[to_square] & them) or (
+            to_square == ep_square and bool(chess.BB_SQUARES[from_square] & pawns))
+        details.append((
+            move,
+            is_capture,
+            letters[board.piece_type_at(from_square) or chess.PAWN],
+            SQUARE_NAMES[from_square],
+            SQUARE_NAMES[to_square]
+        ))
+    return details
@@ -0,0 +1,29 @@
+"""WSGI entry point for production servers.
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+chess-api-backend.py can't be imported by name (the hyphens), so it is
+loaded from its path. Each worker process imports this module after the
+fork and starts its own Stockfish pool; don't use gunicorn's --preload,
+which would import it once in the master before forking.
+"""
+import importlib.util
+import logging
+import os
+import sys
+
+_HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, _HERE)  # For move_classify
+
+_spec = importlib.util.spec_from_file_location(
+    'chess_api_backend', os.path.join(_HERE, 'chess-api-backend.py'))
+backend = importlib.util.module_from_spec(_spec)
+sys.modules['chess_api_backend'] = backend
+_spec.loader.exec_module(backend)
+
+app = backend.app
+
+try:
+    backend.engine_pool.warm_up()
+except Exception as e:
+    logging.getLogger('chess_api_backend').warning("Could not start Stockfish: %s", e)